@@ -0,0 +1,186 @@
+# -----------------------------------------------------------------------------
+# IMPORTS
+
+# Standard library imports
+import collections
+import itertools
+import json
+import random
+import struct
+import time
+import zlib
+from cStringIO import StringIO
+
+# Related third party imports
+import requests
+import requests.adapters
+
+# Local application/library specific imports
+from utils import config
+
+# -----------------------------------------------------------------------------
+# CLASSES
+
+
+class ServerError(Exception):
+    pass
+
+
+class StreamBody(object):
+    """File-like request body concatenating strings and parts of files. The
+    requests library reads it block by block, the length is known upfront."""
+
+    def __init__(self):
+        self.parts = collections.deque()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def addString(self, value):
+        self.addFile(StringIO(value), len(value))
+
+    def addFile(self, f, length):
+        self.parts.append([f, length])
+        self.length += length
+
+    def addGzipString(self, value):
+        self.addString(gzipString(value))
+
+    def addGzipMember(self, f, compress_size, crc, file_size):
+        """Adds already deflated data as one member of a multi-member gzip."""
+        self.addString(gzipHeader())
+        self.addFile(f, compress_size)
+        self.addString(gzipTrailer(crc, file_size))
+
+    def read(self, size=-1):
+        blocks = []
+
+        while self.parts and size != 0:
+            part = self.parts[0]
+            f, remaining = part
+
+            count = remaining if size < 0 else min(size, remaining)
+            block = f.read(count)
+            if len(block) < count:
+                raise IOError("Unexpected end of the request body")
+
+            blocks.append(block)
+            part[1] -= count
+            if size > 0:
+                size -= count
+
+            if not part[1]:
+                self.parts.popleft()
+                f.close()
+
+        return ''.join(blocks)
+
+    def close(self):
+        while self.parts:
+            f, _ = self.parts.popleft()
+            f.close()
+
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS
+
+# These functions never touch the GUI or the database, so they can be called
+# from the upload worker threads too. The requests share one session, which
+# keeps the connections to the API server alive.
+
+
+def post(route, data):
+    json_data = json.dumps(data)
+
+    if config.HTTP_GZIP:
+        json_data = gzipString(json_data)
+
+    return postBody(route, lambda: json_data)
+
+
+def postBody(route, openBody):
+    """Posts the body returned by openBody, which is called again for every
+    retry, since a streamed body can be read only once."""
+    for count in itertools.count():
+        body = openBody()
+
+        try:
+            result = post_core(route, body)
+            return result, result.get('error')
+
+        except ServerError:
+            if count >= config.HTTP_RETRIES:
+                raise
+
+        except requests.Timeout:
+            if count >= config.HTTP_RETRIES:
+                return None, "The server is not responding"
+
+        except requests.ConnectionError:
+            if count >= config.HTTP_RETRIES:
+                return None, "The server is unreachable"
+
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        waitBeforeRetry(count)
+
+
+def post_core(route, body):
+    url = "{}/{}".format(config.API_URL, route)
+    headers = {'content-type': 'application/json'}
+
+    if config.HTTP_GZIP:
+        headers['content-encoding'] = 'gzip'
+
+    r = session.post(url, data=body, headers=headers, timeout=config.HTTP_TIMEOUT)
+
+    if r.status_code == 200:
+        return r.json()
+    elif r.status_code >= 500:
+        raise ServerError(r.content)
+    else:
+        raise Exception(r.content)
+
+
+def waitBeforeRetry(count):
+    # Exponential backoff with full jitter
+    limit = min(config.HTTP_BACKOFF_MAX, config.HTTP_BACKOFF_BASE * 2 ** count)
+    time.sleep(random.uniform(0, limit))
+
+
+def createSession():
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config.HTTP_POOL_SIZE,
+        pool_block=True
+        )
+
+    new_session = requests.Session()
+    new_session.mount('http://', adapter)
+    new_session.mount('https://', adapter)
+
+    return new_session
+
+
+def gzipString(value):
+    compressor = zlib.compressobj(config.HTTP_GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(value) + compressor.flush()
+    return gzipHeader() + data + gzipTrailer(zlib.crc32(value), len(value))
+
+
+def gzipHeader():
+    # Magic number, deflate method, no flags, no mtime, no extra flags, unknown OS
+    return '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def gzipTrailer(crc, size):
+    return struct.pack('<LL', crc & 0xffffffff, size & 0xffffffff)
+
+
+# -----------------------------------------------------------------------------
+# MAIN
+
+session = createSession()
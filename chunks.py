@@ -0,0 +1,466 @@
+# -----------------------------------------------------------------------------
+# IMPORTS
+
+# Standard library imports
+import array
+import datetime
+import gzip
+import itertools
+import json
+import os
+import re
+import struct
+import sys
+import zipfile
+import zlib
+
+# Related third party imports
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Local application/library specific imports
+from utils import config
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS - CONVERSION
+
+# These functions run in the validation worker processes and need nothing
+# but this module. On Windows every worker also imports the main module, which
+# opens the database and starts the GUI only when it is run, see
+# models.openDatabase.
+
+
+def convertChunk(validation, rows, path):
+    valid_rows, invalid_rows = splitRows(validation, rows)
+
+    codec = getCodecToWrite(validation, valid_rows)
+    path += codec.extension
+    codec.write(path, valid_rows)
+
+    return path, codec.name, len(valid_rows), invalid_rows
+
+
+def splitRows(validation, rows):
+    converters = getConverters(validation)
+
+    if all(len(row) == len(converters) for row in rows):
+        return splitColumns(getColumnConverters(validation), rows)
+    else:
+        return splitEachRow(converters, rows)
+
+
+def splitColumns(column_converters, rows):
+    """Converts whole columns at once, marking the invalid rows in a mask."""
+    valid_mask = [True] * len(rows)
+    reasons = {}
+    columns = []
+
+    for column_index, (func, column) in enumerate(zip(column_converters, zip(*rows))):
+        values, errors = func(column)
+        columns.append(values)
+
+        for index, error in errors:
+            if valid_mask[index]:
+                valid_mask[index] = False
+                reasons[index] = (column_index, error)
+
+    converted_rows = zip(*columns) if columns else [()] * len(rows)
+    valid_rows = list(itertools.compress(converted_rows, valid_mask))
+    invalid_rows = [getInvalidRow(rows[index], *reasons[index]) for index in sorted(reasons)]
+
+    return valid_rows, invalid_rows
+
+
+def splitEachRow(converters, rows):
+    # Rows with missing or extra cells are converted one by one, the cells
+    # without a converter are dropped
+    valid_rows = []
+    invalid_rows = []
+
+    for row in rows:
+        values = []
+
+        for column_index, (func, value) in enumerate(zip(converters, row)):
+            try:
+                values.append(func(value))
+            except Exception, e:
+                invalid_rows.append(getInvalidRow(row, column_index, str(e)))
+                break
+
+        else:
+            valid_rows.append(values)
+
+    return valid_rows, invalid_rows
+
+
+def getInvalidRow(row, column_index, error):
+    # The row in the errors file starts with the column number and the reason
+    return [column_index + 1, error] + list(row)
+
+
+def getConverters(validation):
+    d = {
+        'number': convertNumber,
+        'text': convertText,
+        'datetimestamp': convertStamp
+        }
+
+    return [d[v] for v in validation.split(',')]
+
+
+def getColumnConverters(validation):
+    d = {
+        'number': convertNumbers,
+        'text': convertTexts,
+        'datetimestamp': convertStamps
+        }
+
+    return [d[v] for v in validation.split(',')]
+
+
+# The values are strings from a CSV file, or typed values from posted JSON.
+# Numbers are accepted as they are, but booleans are not numbers, and only
+# strings are dates.
+
+
+def convertNumber(value):
+    if type(value) is bool:
+        raise ValueError("could not convert boolean to float: {}".format(value))
+
+    return float(value)
+
+
+def convertStamp(value):
+    if not isinstance(value, basestring):
+        raise ValueError(getStampError(value))
+
+    # Fast path for the zero padded dates, strptime is slow
+    if padded_date_pattern.match(value):
+        datetime.date(int(value[:4]), int(value[5:7]), int(value[8:]))
+        return value + 'T00:00:00'
+    else:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').isoformat()
+
+
+def getStampError(value):
+    return "time data {!r} does not match format '%Y-%m-%d'".format(value)
+
+
+def convertText(value):
+    if isinstance(value, basestring):
+        return value
+    else:
+        return str(value)
+
+
+def convertNumbers(column):
+    # Posted floats are kept as they are, without a new list
+    if all(type(value) is float for value in column):
+        return column, []
+
+    if bool not in set(map(type, column)):
+        try:
+            return map(float, column), []
+        except Exception:
+            pass
+
+    return convertCells(convertNumber, column)
+
+
+def convertStamps(column):
+    # The same dates are repeated a lot, so they are parsed only once
+    parsed = {}
+    values = []
+    errors = []
+
+    for index, value in enumerate(column):
+        if not isinstance(value, basestring):
+            values.append(None)
+            errors.append((index, getStampError(value)))
+            continue
+
+        if value not in parsed:
+            try:
+                parsed[value] = (convertStamp(value), None)
+            except Exception, e:
+                parsed[value] = (None, str(e))
+
+        stamp, error = parsed[value]
+        values.append(stamp)
+
+        if error:
+            errors.append((index, error))
+
+    return values, errors
+
+
+def convertTexts(column):
+    if all(isinstance(value, basestring) for value in column):
+        return column, []
+    else:
+        return convertCells(convertText, column)
+
+
+def convertCells(func, column):
+    values = []
+    errors = []
+
+    for index, value in enumerate(column):
+        try:
+            values.append(func(value))
+        except Exception, e:
+            values.append(None)
+            errors.append((index, str(e)))
+
+    return values, errors
+
+
+# -----------------------------------------------------------------------------
+# CHUNK CODECS
+
+# A codec writes the valid rows of a chunk into a file, and adds the file to
+# the body of the upload_rows request, with the rows spliced between the
+# prefix and the suffix of the JSON envelope. The name of the codec is saved
+# in the chunk row, so the files of any codec stay readable.
+
+
+class ZipJsonCodec(object):
+    """JSON array in a zip archive, the original format of the chunks."""
+
+    name = 'zip-json'
+    extension = '.json.zip'
+
+    def write(self, path, rows):
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('chunk.csv', json.dumps(rows))
+
+    def fillBody(self, body, path, prefix, suffix):
+        with zipfile.ZipFile(path, 'r') as z:
+            info = z.getinfo('chunk.csv')
+
+            if config.HTTP_GZIP and info.compress_type == zipfile.ZIP_DEFLATED:
+                f = openRawMember(path, info)
+                body.addGzipString(prefix)
+                body.addGzipMember(f, info.compress_size, info.CRC, info.file_size)
+                body.addGzipString(suffix)
+
+            elif config.HTTP_GZIP:
+                body.addGzipString(prefix + z.read(info) + suffix)
+
+            else:
+                body.addString(prefix)
+                body.addFile(z.open(info), info.file_size)
+                body.addString(suffix)
+
+
+class JsonCodec(object):
+    """Uncompressed JSON array, sent to the server as it is on the disk."""
+
+    name = 'json'
+    extension = '.json'
+
+    def write(self, path, rows):
+        with open(path, 'wb') as f:
+            json.dump(rows, f)
+
+    def fillBody(self, body, path, prefix, suffix):
+        if config.HTTP_GZIP:
+            with open(path, 'rb') as f:
+                body.addGzipString(prefix + f.read() + suffix)
+        else:
+            body.addString(prefix)
+            body.addFile(open(path, 'rb'), os.path.getsize(path))
+            body.addString(suffix)
+
+
+class GzipJsonCodec(object):
+    """JSON array in a gzip file, which is a valid member of a gzip encoded
+    request body as it is."""
+
+    name = 'gzip-json'
+    extension = '.json.gz'
+
+    def write(self, path, rows):
+        with gzip.GzipFile(path, 'wb', config.CHUNK_COMPRESSION_LEVEL) as f:
+            f.write(json.dumps(rows))
+
+    def fillBody(self, body, path, prefix, suffix):
+        if config.HTTP_GZIP:
+            body.addGzipString(prefix)
+            body.addFile(open(path, 'rb'), os.path.getsize(path))
+            body.addGzipString(suffix)
+        else:
+            body.addString(prefix)
+            body.addFile(gzip.GzipFile(path, 'rb'), getGzipSize(path))
+            body.addString(suffix)
+
+
+class ColumnarCodec(object):
+    """Typed binary columns: the numbers as an array of doubles, the texts as
+    an array of lengths and the concatenated bytes, compressed with
+    CHUNK_COMPRESSOR. Only rectangular chunks can be written this way."""
+
+    name = 'columnar'
+    extension = '.columns'
+    magic = 'TBC1'
+
+    def __init__(self, validation):
+        self.types = ['d' if v == 'number' else 's' for v in validation.split(',')]
+
+    def canWrite(self, rows):
+        return all(len(row) == len(self.types) for row in rows)
+
+    def write(self, path, rows):
+        parts = [struct.pack('<II', len(rows), len(self.types))]
+
+        for type_code, column in zip(self.types, zip(*rows)):
+            if type_code == 'd':
+                parts.append(littleEndian(array.array('d', column)).tostring())
+            else:
+                values = [v.encode('utf-8') if isinstance(v, unicode) else v for v in column]
+                lengths = array.array('I', [len(v) for v in values])
+                parts.append(littleEndian(lengths).tostring())
+                parts.append(''.join(values))
+
+        compressor = getCompressor(config.CHUNK_COMPRESSOR)
+        with open(path, 'wb') as f:
+            f.write(self.magic)
+            f.write(struct.pack('<B', len(compressor.name)) + compressor.name)
+            f.write(compressor.compress(''.join(parts)))
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        if data[:4] != self.magic:
+            raise IOError("Invalid columnar chunk: {}".format(path))
+
+        name_length = ord(data[4])
+        compressor = getCompressor(data[5:5+name_length], fallback=False)
+        data = buffer(compressor.decompress(data[5+name_length:]))
+
+        row_count, column_count = struct.unpack_from('<II', data)
+        offset = struct.calcsize('<II')
+        columns = []
+
+        for type_code in self.types[:column_count]:
+            if type_code == 'd':
+                values, offset = readArray(data, offset, 'd', row_count)
+                columns.append(values.tolist())
+            else:
+                lengths, offset = readArray(data, offset, 'I', row_count)
+                column = []
+                for length in lengths:
+                    column.append(data[offset:offset+length])
+                    offset += length
+                columns.append(column)
+
+        return zip(*columns) if columns else [()] * row_count
+
+    def fillBody(self, body, path, prefix, suffix):
+        json_str = prefix + json.dumps(self.read(path)) + suffix
+
+        if config.HTTP_GZIP:
+            body.addGzipString(json_str)
+        else:
+            body.addString(json_str)
+
+
+class Compressor(object):
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def getCodec(name, validation):
+    if name == 'columnar':
+        return ColumnarCodec(validation)
+
+    codecs = {
+        ZipJsonCodec.name: ZipJsonCodec,
+        JsonCodec.name: JsonCodec,
+        GzipJsonCodec.name: GzipJsonCodec,
+        }
+
+    # The chunks saved before the codecs existed have no codec
+    return codecs[name or ZipJsonCodec.name]()
+
+
+def getCodecToWrite(validation, rows):
+    codec = getCodec(config.CHUNK_CODEC, validation)
+
+    if hasattr(codec, 'canWrite') and not codec.canWrite(rows):
+        return GzipJsonCodec()
+    else:
+        return codec
+
+
+def getCompressor(name, fallback=True):
+    # The lz4 and zstandard packages are optional, zlib is used without them
+    level = config.CHUNK_COMPRESSION_LEVEL
+
+    if name == 'lz4' and lz4:
+        return Compressor(name, lz4.frame.compress, lz4.frame.decompress)
+
+    elif name == 'zstd' and zstandard:
+        compress = zstandard.ZstdCompressor(level=level).compress
+        decompress = zstandard.ZstdDecompressor().decompress
+        return Compressor(name, compress, decompress)
+
+    elif name == 'none':
+        return Compressor(name, str, str)
+
+    elif name == 'zlib' or fallback:
+        return Compressor('zlib', lambda data: zlib.compress(data, level), zlib.decompress)
+
+    else:
+        raise IOError("The {} compressor is not installed".format(name))
+
+
+def littleEndian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values
+
+
+def readArray(data, offset, type_code, count):
+    values = array.array(type_code)
+    end = offset + values.itemsize * count
+    values.fromstring(data[offset:end])
+
+    return littleEndian(values), end
+
+
+def getGzipSize(path):
+    # The last 4 bytes of a gzip file hold the size of the uncompressed data
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<L', f.read(4))[0]
+
+
+def openRawMember(path, info):
+    """Opens the chunk file at the compressed data of the zip member."""
+    f = open(path, 'rb')
+    f.seek(info.header_offset)
+
+    header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+    name_length, extra_length = header[10], header[11]
+    f.seek(name_length + extra_length, os.SEEK_CUR)
+
+    return f
+
+
+# -----------------------------------------------------------------------------
+# MAIN
+
+padded_date_pattern = re.compile(r'\d{4}-\d\d-\d\d\Z')
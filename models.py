@@ -3,10 +3,11 @@
 
 # Standard library imports
 import os
+import time
 
 # Related third party imports
-from sqlalchemy import create_engine, func
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import create_engine, event, func
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship, sessionmaker
 
@@ -59,13 +60,39 @@ class Project(Base):
     records_invalid = Column(Integer)
     records_uploaded = Column(Integer)
 
+    # Relative share of the processing time among the projects of the same type
+    priority = Column(Integer)
+
+    # Read cursor of the ingest queue of a Server project: the next row is the
+    # ingest_row-th row of the record at ingest_offset of the segment
+    ingest_segment_id = Column(Integer)
+    ingest_offset = Column(Integer)
+    ingest_row = Column(Integer)
+
+    # The input file at the start of the validation, and the position after
+    # the last committed chunk, in the input and in the errors file
+    source_size = Column(Integer)
+    source_mtime = Column(Float)
+    checkpoint_offset = Column(Integer)
+    checkpoint_row = Column(Integer)
+    checkpoint_errors_size = Column(Integer)
+    checkpoint_errors_count = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_project_visible', 'visible'),
+        Index('ix_project_in_progress', 'in_progress', 'type_name', 'idle'),
+        Index('ix_project_paused', 'paused'),
+        )
+
     def save(self):
         session.add(self)
         session.commit()
 
-        for listener in project_listeners:
+        for listener in save_listeners:
             listener(self)
 
+        notifyListeners(self)
+
     @property
     def full_status(self):
         if self.paused:
@@ -98,23 +125,121 @@ class Chunk(Base):
     project_id = Column(Integer, ForeignKey('project.id'))
     project = relationship("Project", backref=backref('chunks', order_by=id))
 
+    # The post file of the chunk, only set by the older versions
     json_path = Column(String)
     path = Column(String)
+    codec = Column(String)
 
     records_valid = Column(Integer)
     records_invalid = Column(Integer)
     uploaded = Column(Boolean)
 
+    __table_args__ = (
+        Index('ix_chunk_uploaded', 'project_id', 'uploaded', 'id'),
+        Index('ix_chunk_json_path', 'project_id', 'json_path'),
+        )
+
     def save(self):
         session.add(self)
         session.commit()
 
 
+class Segment(Base):
+    """Ingest queue of the Server projects: the segment files of the received
+    POST requests, in the order of arrival."""
+    __tablename__ = 'segment'
+
+    id = Column(Integer, primary_key=True)
+
+    project_id = Column(Integer, ForeignKey('project.id'))
+    path = Column(String)
+
+    # The IDs of the removed segments must not be reused, the read cursor
+    # points past them
+    __table_args__ = (
+        Index('ix_segment_project', 'project_id', 'id'),
+        {'sqlite_autoincrement': True}
+        )
+
+
+# -----------------------------------------------------------------------------
+# CLASSES
+
+
+class ChunkWriter(object):
+    """Buffers the new chunks of a project and commits them in one transaction,
+    together with the increased record counters of the project."""
+
+    def __init__(self, project):
+        self.project = project
+        self.reset()
+
+    def reset(self):
+        self.chunks = []
+        self.records_valid = 0
+        self.records_invalid = 0
+        self.checkpoint = None
+        self.flushed_at = time.time()
+
+    def addChunk(self, path, codec, records_valid, records_invalid, checkpoint=None):
+        chunk = Chunk(
+            project_id=self.project.id,
+            path=path,
+            codec=codec,
+            records_valid=records_valid,
+            records_invalid=records_invalid,
+            uploaded=False
+            )
+
+        self.chunks.append(chunk)
+        self.records_valid += records_valid
+        self.records_invalid += records_invalid
+        self.checkpoint = checkpoint or self.checkpoint
+
+        self.flushIfNeeded()
+
+    def addInvalidRecords(self, records_invalid, checkpoint=None):
+        # The invalid records found outside of any chunk
+        self.records_invalid += records_invalid
+        self.checkpoint = checkpoint or self.checkpoint
+
+        self.flushIfNeeded()
+
+    def flushIfNeeded(self):
+        too_many = len(self.chunks) >= config.CHUNKS_PER_COMMIT
+        too_old = time.time() - self.flushed_at >= config.SECONDS_PER_COMMIT
+        if too_many or too_old:
+            self.flush()
+
+    def flush(self):
+        if self.chunks or self.records_invalid:
+            session.add_all(self.chunks)
+
+            self.project.records_valid = (self.project.records_valid or 0) + self.records_valid
+            self.project.records_invalid = (self.project.records_invalid or 0) + self.records_invalid
+
+            if self.checkpoint:
+                for name, value in self.checkpoint.items():
+                    setattr(self.project, name, value)
+
+                self.project.checkpoint_row = self.project.records_valid + self.project.records_invalid
+
+            self.project.save()
+
+        self.reset()
+
+
 # -----------------------------------------------------------------------------
 # FUNCTIONS - CONFIG
 
 
 def getLoginToken():
+    # The token is cached in memory, so this doesn't touch the database and
+    # can be called from the worker threads too
+    return login_token
+
+
+def loadLoginToken():
     config = session.query(Config).first()
 
     if config:
@@ -122,18 +247,51 @@ def getLoginToken():
 
 
 def setLoginToken(value):
+    global login_token
+
     config = session.query(Config).first() or Config()
     config.login_token = value
 
     session.add(config)
     session.commit()
 
+    login_token = value
+
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS - NOTIFICATIONS
+
+# The project listeners are called at most NOTIFICATIONS_PER_SECOND times per
+# second, with the projects changed since the previous call. The GUI calls
+# deliverNotifications periodically, so the last changes are delivered too.
+# The save listeners are called at every save, so they must be cheap.
+
+
+def notifyListeners(project):
+    changed_projects[project.id] = project
+
+    if time.time() - delivered_at >= 1.0 / config.NOTIFICATIONS_PER_SECOND:
+        deliverNotifications()
+
+
+def deliverNotifications():
+    global delivered_at
+
+    if changed_projects:
+        projects = changed_projects.values()
+        changed_projects.clear()
+        delivered_at = time.time()
+
+        for project in projects:
+            for listener in project_listeners:
+                listener(project)
+
 
 # -----------------------------------------------------------------------------
 # FUNCTIONS - PROJECT
 
 
-def addProject(name, form_name, type_name, path, project_token, delimiter, validation):
+def addProject(name, form_name, type_name, path, project_token, delimiter, validation, priority=1):
     project = Project(
         name=name,
         form_name=form_name,
@@ -142,6 +300,7 @@ def addProject(name, form_name, type_name, path, project_token, delimiter, valid
         project_token=project_token,
         delimiter=delimiter or ',',
         validation=validation,
+        priority=priority,
         records_valid=0,
         records_invalid=0,
         visible=True,
@@ -173,6 +332,10 @@ def getProjects(visible):
     return session.query(Project).filter(Project.visible==visible).all()
 
 
+def getServerProjects():
+    return session.query(Project).filter(Project.type_name=='Server').all()
+
+
 def getRunningProjects():
     projects = session.query(Project).filter(Project.in_progress==True).all()
     projects += session.query(Project).filter(Project.paused==True).all()
@@ -197,18 +360,6 @@ def hasInProgress():
 # FUNCTIONS - CHUNKS
 
 
-def addChunk(project, path, json_path, records_valid, records_invalid):
-    chunk = Chunk(
-        project=project,
-        json_path=json_path,
-        path=path,
-        records_valid=records_valid,
-        records_invalid=records_invalid,
-        uploaded=False
-        )
-    chunk.save()
-
-
 def updateRecordsCount(project):
     valid = session.query(func.sum(Chunk.records_valid)).filter(Chunk.project==project).scalar()
     invalid = session.query(func.sum(Chunk.records_invalid)).filter(Chunk.project==project).scalar()
@@ -218,20 +369,61 @@ def updateRecordsCount(project):
     project.save()
 
 
-def getChunksToUpload(project):
-    query = session.query(Chunk).filter(Chunk.project==project, Chunk.uploaded==False)
-    return query.all()
+def iterChunksToUpload(project):
+    """Yields (id, path, codec, records_valid) tuples, reading one page at a time,
+    so the memory use doesn't depend on the number of chunks."""
+    last_id = 0
+
+    while True:
+        query = session.query(Chunk.id, Chunk.path, Chunk.codec, Chunk.records_valid)
+        query = query.filter(
+            Chunk.project_id==project.id,
+            Chunk.uploaded==False,
+            Chunk.id > last_id
+            )
+        chunks = query.order_by(Chunk.id).limit(config.CHUNKS_PER_PAGE).all()
 
+        for chunk in chunks:
+            yield chunk
 
-def getUploadedCount(project):
+        if len(chunks) < config.CHUNKS_PER_PAGE:
+            break
+
+        last_id = chunks[-1].id
+
+
+def hasChunksToUpload(project):
+    query = session.query(Chunk.id).filter(Chunk.project_id==project.id, Chunk.uploaded==False)
+    return session.query(query.exists()).scalar()
+
+
+def setChunkUploaded(project, chunk):
+    query = session.query(Chunk).filter(Chunk.id==chunk.id)
+    query.update({'uploaded': True}, synchronize_session=False)
+
+    project.records_uploaded = (project.records_uploaded or 0) + chunk.records_valid
+    project.save()
+
+
+def updateUploadedCount(project):
     query = session.query(func.sum(Chunk.records_valid))
     query = query.filter(Chunk.project==project, Chunk.uploaded==True)
-    return query.scalar()
+
+    project.records_uploaded = query.scalar() or 0
+    project.save()
+
+
+def getChunkPaths(project):
+    query = session.query(Chunk.path).filter(Chunk.project_id==project.id)
+    return set(path for (path,) in query)
 
 
 def removeBrokenChunks(project, json_path):
-    session.query(Chunk).filter(Chunk.project==project, Chunk.json_path==json_path).delete()
-    session.commit()
+    query = session.query(Chunk).filter(Chunk.project==project, Chunk.json_path==json_path)
+    if query.delete():
+        updateRecordsCount(project)
+    else:
+        session.commit()
 
 
 def removeChunks(project):
@@ -240,19 +432,128 @@ def removeChunks(project):
 
 
 # -----------------------------------------------------------------------------
-# ENGINE
+# FUNCTIONS - SEGMENT
+
+# The read cursor of a project is committed together with the chunks made of
+# the rows before it, so every received row gets into exactly one chunk.
+
+
+def addSegments(project_id, paths):
+    session.add_all(Segment(project_id=project_id, path=path) for path in paths)
+    session.commit()
+
+
+def getNextSegment(project):
+    query = session.query(Segment).filter(
+        Segment.project_id==project.id,
+        Segment.id >= (project.ingest_segment_id or 0)
+        )
+    return query.order_by(Segment.id).first()
+
+
+def getSegmentPaths(project):
+    query = session.query(Segment.path).filter(Segment.project_id==project.id)
+    return set(path for (path,) in query)
+
+
+def removeSegment(project, segment, checkpoint):
+    # Moves the cursor past the segment
+    session.delete(segment)
+
+    project.ingest_segment_id = segment.id + 1
+    project.ingest_offset = 0
+    project.ingest_row = 0
 
-if not os.path.exists(config.DB_FOLDER):
-    os.makedirs(config.DB_FOLDER)
+    for name, value in checkpoint.items():
+        setattr(project, name, value)
 
-path = os.path.join(config.DB_FOLDER, 'main.db')
-engine = create_engine('sqlite:///{}'.format(path))
+    project.save()
+
+
+# -----------------------------------------------------------------------------
+# ENGINE
 
-Base.metadata.create_all(engine)
+# The database is opened by openDatabase, not on import. On Windows the
+# validation workers import the main module, and with it this one, and they
+# must not open or migrate the database.
+
+# Every item upgrades the schema of an existing database by one version,
+# new databases get the recent schema from create_all
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS ix_project_visible ON project (visible)",
+        "CREATE INDEX IF NOT EXISTS ix_project_in_progress ON project (in_progress, type_name, idle)",
+        "CREATE INDEX IF NOT EXISTS ix_project_paused ON project (paused)",
+        "CREATE INDEX IF NOT EXISTS ix_chunk_uploaded ON chunk (project_id, uploaded, id)",
+        "CREATE INDEX IF NOT EXISTS ix_chunk_json_path ON chunk (project_id, json_path)",
+        ],
+    [
+        "ALTER TABLE chunk ADD COLUMN codec VARCHAR",
+        ],
+    [
+        "ALTER TABLE project ADD COLUMN source_size INTEGER",
+        "ALTER TABLE project ADD COLUMN source_mtime FLOAT",
+        "ALTER TABLE project ADD COLUMN checkpoint_offset INTEGER",
+        "ALTER TABLE project ADD COLUMN checkpoint_row INTEGER",
+        "ALTER TABLE project ADD COLUMN checkpoint_errors_size INTEGER",
+        "ALTER TABLE project ADD COLUMN checkpoint_errors_count INTEGER",
+        ],
+    [
+        "ALTER TABLE project ADD COLUMN priority INTEGER",
+        ],
+    [
+        "ALTER TABLE project ADD COLUMN ingest_segment_id INTEGER",
+        "ALTER TABLE project ADD COLUMN ingest_offset INTEGER",
+        "ALTER TABLE project ADD COLUMN ingest_row INTEGER",
+        ],
+    ]
+
+
+def setPragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode={}".format(config.SQLITE_JOURNAL_MODE))
+    cursor.execute("PRAGMA synchronous={}".format(config.SQLITE_SYNCHRONOUS))
+    cursor.execute("PRAGMA cache_size={}".format(config.SQLITE_CACHE_SIZE))
+    cursor.close()
+
+
+def migrate(engine, is_new):
+    with engine.begin() as connection:
+        version = connection.execute("PRAGMA user_version").scalar()
+
+        if not is_new:
+            for statements in MIGRATIONS[version:]:
+                for statement in statements:
+                    connection.execute(statement)
+
+        connection.execute("PRAGMA user_version={}".format(len(MIGRATIONS)))
+
+
+def openDatabase():
+    global session, login_token
+
+    if not os.path.exists(config.DB_FOLDER):
+        os.makedirs(config.DB_FOLDER)
+
+    path = os.path.join(config.DB_FOLDER, 'main.db')
+    is_new = not os.path.exists(path)
+
+    engine = create_engine('sqlite:///{}'.format(path))
+    event.listen(engine, 'connect', setPragmas)
+
+    Base.metadata.create_all(engine)
+    migrate(engine, is_new)
+
+    session = sessionmaker(bind=engine)()
+    login_token = loadLoginToken()
 
 
 # -----------------------------------------------------------------------------
 # MAIN
 
-session = sessionmaker(bind=engine)()
+session = None
 project_listeners = []
+save_listeners = []
+changed_projects = {}
+delivered_at = 0
+login_token = None
@@ -2,41 +2,66 @@
 # IMPORTS
 
 # Standard library imports
+import collections
 import csv
 import datetime
+import functools
+import itertools
 import json
+import multiprocessing
 import os
+import struct
 import sys
-import zipfile
+import time
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 # Related third party imports
 
 # Local application/library specific imports
 from utils import config
 from utils import excepthook
+import api
+import chunks
 import models
+import segments
 
 # -----------------------------------------------------------------------------
 # CLASSES - PROCESS MANAGER
 
 
 class ProcessManager(object):
+    """Runs the steps of the processes in rounds scheduled with callLater, so
+    the event loop handles the GUI and the network between two rounds. Nothing
+    is scheduled while there is no live process. The workers wake the manager
+    with callFromThread when a job is done."""
 
-    def __init__(self, post, processEvents):
-        self.post = post
-        self.processEvents = processEvents
+    def __init__(self, handleResult, callLater, callFromThread):
+        global wake_up
+
+        self.handleResult = handleResult
+        self.callLater = callLater
         self.processes = {}
+        self.delayed_call = None
         self.running = False
+        self.run_again = False
+
+        wake_up = functools.partial(callFromThread, self.runProcesses)
 
     def addProcess(self, project, process):
+        process.passed = self.getMinPassed()
         self.processes[project.id] = process
 
     def processJsons(self, project):
         if not project.id in self.processes:
-            process = ServerProcess(project, self.post)
+            process = ServerProcess(project, self.handleResult)
             self.addProcess(project, process)
 
         process = self.processes[project.id]
+        if project.idle:
+            # Starts with the others, like a continued process
+            process.passed = self.getMinPassed()
+
         process.processJsons()
         self.runProcesses()
 
@@ -57,31 +82,77 @@ class ProcessManager(object):
     def continueProcess(self, project):
         if project.id in self.processes:
             process = self.processes[project.id]
+            process.passed = self.getMinPassed()
             process.continueProcess()
 
     def runProcesses(self):
-        if not self.running:
-            self.running = True
-            self.runProcessesCore()
-            self.running = False
+        self.scheduleRound(0)
 
-    def runProcessesCore(self):
-        while True:
-            for p in self.processes.values():
-                if not p.project.paused:
-                    p.runOneStep()
+    def scheduleRound(self, seconds):
+        if self.delayed_call and self.delayed_call.active():
+            if not seconds:
+                self.delayed_call.reset(0)
+        else:
+            self.delayed_call = self.callLater(seconds, self.runRound)
 
-            self.processEvents()
+    def runRound(self):
+        global waiting
 
-            self.processes = {id: p for (id, p) in self.processes.items() if p.project.in_progress}
+        # A step can open a dialog, and its event loop can run a round while
+        # a generator is executing, that round is run after this one
+        if self.running:
+            self.run_again = True
+            return
 
-            if not self.live_processes:
-                break
+        self.running = True
+        self.run_again = False
+
+        try:
+            busy = False
+            live_processes = self.live_processes
+            for _ in live_processes:
+                waiting = False
+                self.runNextStep(live_processes)
+                busy = busy or not waiting
+        finally:
+            self.running = False
+
+        self.processes = {id: p for (id, p) in self.processes.items() if p.project.in_progress}
+
+        # When every process is only waiting for the workers, the next round
+        # is run when a job is done, the polling is only a fallback
+        if self.live_processes:
+            self.scheduleRound(0 if busy or self.run_again else config.POLL_SECONDS)
 
     @property
     def live_processes(self):
         return [p for p in self.processes.values() if not p.project.paused and not p.project.idle]
 
+    def runNextStep(self, processes):
+        """Stride scheduling: runs the process that got the least steps for its
+        weight so far. The File and the Server projects get an equal share, which
+        is divided between the projects of the type by their priorities."""
+        process = min(processes, key=lambda p: p.passed)
+        process.passed += 1.0 / self.getWeight(process, processes)
+        process.runOneStep()
+
+    def getWeight(self, process, processes):
+        same_type = [p for p in processes if p.project.type_name == process.project.type_name]
+        total = sum(self.getPriority(p) for p in same_type)
+        return float(self.getPriority(process)) / total
+
+    def getMinPassed(self):
+        # New and continued processes start with the others, instead of
+        # catching up with them
+        live_processes = self.live_processes
+        if live_processes:
+            return min(p.passed for p in live_processes)
+        else:
+            return 0
+
+    def getPriority(self, process):
+        return process.project.priority or 1
+
 # -----------------------------------------------------------------------------
 # PROCESS
 
@@ -144,13 +215,12 @@ class Process(object):
 class ValidationAndSplitProcess(Process):
 
     def runProcess(self):
-        self.converters = getConverters(self.project)
-        self.resetProject()
-
-        with open(self.project.path) as f:
-            reader = csv.reader(f, delimiter=str(self.project.delimiter))
-            for _ in processRows(self.project, self.converters, reader):
+        try:
+            for _ in self.validateFile():
                 yield
+        except DiskBudgetError, e:
+            self.stopProcess(str(e))
+            return
 
         self.markAsFinished()
 
@@ -158,99 +228,506 @@ class ValidationAndSplitProcess(Process):
         self.project.status = self.project.ready_status
         self.project.save()
 
+    def validateFile(self):
+        if self.canResume():
+            self.resumeProject()
+        else:
+            self.resetProject()
+
+        self.errors = ErrorsFile(self.project)
+
+        try:
+            with open(self.project.path, 'rb') as f:
+                f.seek(self.project.checkpoint_offset)
+                self.lines = LineReader(f)
+
+                reader = csv.reader(self.lines, delimiter=str(self.project.delimiter))
+                for _ in processRows(self.project, self.errors, reader, self.getCheckpoint, self.freeDiskSpace):
+                    yield
+        finally:
+            self.errors.close()
+
+    def freeDiskSpace(self):
+        # The chunks are uploaded only after the validation, so waiting for
+        # the space would never end
+        raise DiskBudgetError()
+
     def resetProject(self):
         if self.project.errors_file:
-            os.remove(self.project.errors_file)
+            for path in (self.project.errors_file, getIndexPath(self.project.errors_file)):
+                removeFile(path)
+
             self.project.errors_file = None
 
         for name in os.listdir(self.project.chunks_folder):
             path = os.path.join(self.project.chunks_folder, name)
-            os.remove(path)
+            removeFile(path)
 
         self.project.status = "Validating and splitting..."
         self.project.records_valid = 0
         self.project.records_invalid = 0
+        self.project.source_size = os.path.getsize(self.project.path)
+        self.project.source_mtime = os.path.getmtime(self.project.path)
+        self.project.checkpoint_offset = 0
+        self.project.checkpoint_row = 0
+        self.project.checkpoint_errors_size = 0
+        self.project.checkpoint_errors_count = 0
         self.project.save()
 
         models.removeChunks(self.project)
 
+    def canResume(self):
+        # The checkpoint is valid only if the input file hasn't changed since
+        return bool(
+            self.project.checkpoint_offset and
+            self.project.source_size == os.path.getsize(self.project.path) and
+            self.project.source_mtime == os.path.getmtime(self.project.path)
+            )
+
+    def resumeProject(self):
+        # Removes everything written after the last committed chunk
+        paths = models.getChunkPaths(self.project)
+        for name in os.listdir(self.project.chunks_folder):
+            path = os.path.join(self.project.chunks_folder, name)
+            if path not in paths:
+                removeFile(path)
 
-def processRows(project, converters, rows, json_path=None):
-    chunk = []
+        truncateErrorsFile(self.project)
 
-    for row in rows:
-        chunk.append(row)
+        self.project.status = "Validating and splitting..."
+        self.project.save()
 
-        if len(chunk) == config.ROWS_PER_CHUNK:
-            processChunk(project, converters, chunk, json_path)
-            chunk = []
+    def getCheckpoint(self):
+        return {'checkpoint_offset': self.lines.offset}
+
+
+class StreamingProcess(ValidationAndSplitProcess):
+    """Validates and uploads a File project in one pass. The chunks are still
+    committed to the database before the upload, so a stopped process can be
+    continued, but they are uploaded while the rest of the file is validated.
+    The reading waits when too many validated rows are waiting for upload."""
+
+    def __init__(self, project, handleResult):
+        self.handleResult = handleResult
+        self.window = UploadWindow()
+        self.validating = True
+
+        super(StreamingProcess, self).__init__(project)
+
+    def runProcess(self):
+        uploading = self.uploadStream()
+
+        try:
+            for _ in self.validateFile():
+                while self.isBacklogFull() and self.project.in_progress:
+                    uploading.next()
+                    yield
+
+                if not self.project.in_progress:
+                    return
+
+                uploading.next()
+                yield
+        except DiskBudgetError, e:
+            self.stopProcess(str(e))
+            return
+
+        self.validating = False
+        self.project.validated = True
+        self.project.status = "Uploading..."
+        self.project.save()
+
+        for _ in uploading:
             yield
 
-    if chunk:
-        processChunk(project, converters, chunk, json_path)
+        if self.project.in_progress:
+            self.markAsFinished()
+            self.project.uploaded = True
+            self.project.status = "Done"
+            self.project.save()
 
+    def uploadStream(self):
+        models.updateUploadedCount(self.project)
 
-def processChunk(project, converters, rows, json_path):
-    project.status = "Validating and splitting..."
-    project.save()
+        while self.project.in_progress:
+            for _ in uploadChunks(self, self.project):
+                yield
+
+            if not self.validating and not models.hasChunksToUpload(self.project):
+                break
+
+            yield
+
+    def freeDiskSpace(self):
+        # The uploads run between the steps of the validation
+        return waitForDiskSpace(self.project)
+
+    def isBacklogFull(self):
+        backlog = (self.project.records_valid or 0) - (self.project.records_uploaded or 0)
+        return backlog >= config.STREAMING_BACKLOG_ROWS
+
+
+class LineReader(object):
+    """Iterates over the lines of a file, keeping the offset of the end of the
+    last line read. Iterating over the file itself would read ahead."""
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+
+        self.offset += len(line)
+        return line
+
+
+class ErrorsFile(object):
+    """Collects the invalid rows of a process and appends them to the errors
+    file of the project in batches, as CSV with the delimiter of the project.
+    The file is opened only once, at the first invalid row.
+
+    The offset of every row is written to a sidecar index file, after the
+    width of the widest row, so the rows can be read page by page by
+    ErrorsFileReader."""
+
+    def __init__(self, project):
+        self.project = project
+        self.path = os.path.join(config.DB_FOLDER, str(project.id), 'validating_errors.csv')
+        self.index_path = getIndexPath(self.path)
+        self.rows = []
+        self.f = None
+
+    def addRows(self, rows):
+        self.rows.extend(rows)
+
+    def takeRows(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def flush(self):
+        if self.rows and not self.f:
+            # Flushes the rows after the header of a new file
+            self.open()
+
+        if self.rows:
+            buf = StringIO()
+            writer = csv.writer(buf, delimiter=str(self.project.delimiter))
+            offsets = []
+
+            for row in self.rows:
+                offsets.append(self.size + buf.tell())
+                writer.writerow(encodeCells(row))
+
+            self.f.write(buf.getvalue())
+            self.f.flush()
+            self.size += buf.tell()
+
+            self.index.seek(0, os.SEEK_END)
+            self.index.write(packOffsets(offsets))
+            self.count += len(offsets)
+
+            width = max(len(row) for row in self.rows)
+            if width > self.width:
+                self.width = width
+                self.index.seek(0)
+                self.index.write(struct.pack(INDEX_HEADER, width))
+
+            self.index.flush()
+
+            self.rows = []
+
+    def open(self):
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if os.path.exists(self.path) and not os.path.exists(self.index_path):
+            convertOldErrorsFile(self.project)
+
+        self.f = open(self.path, 'ab')
+        self.f.seek(0, os.SEEK_END)
+        self.size = self.f.tell()
+
+        if not os.path.exists(self.index_path):
+            with open(self.index_path, 'wb') as index:
+                index.write(struct.pack(INDEX_HEADER, 0))
+
+        # Not opened for appending, the header is updated in place
+        self.index = open(self.index_path, 'r+b')
+        self.width = readIndexHeader(self.index)
+        self.index.seek(0, os.SEEK_END)
+        self.count = getIndexCount(self.index.tell())
+
+        if not self.size:
+            header = ["Column", "Error"] + self.project.validation.split(',')
+            self.rows.insert(0, header)
+            self.flush()
+
+        if self.project.errors_file != self.path:
+            self.project.errors_file = self.path
+            self.project.save()
+
+    def getCheckpoint(self):
+        if self.f:
+            size, count = self.size, self.count
+        elif os.path.exists(self.path) and os.path.exists(self.index_path):
+            size = os.path.getsize(self.path)
+            count = getIndexCount(os.path.getsize(self.index_path))
+        else:
+            size, count = 0, 0
+
+        return {'checkpoint_errors_size': size, 'checkpoint_errors_count': count}
+
+    def close(self):
+        self.flush()
+
+        if self.f:
+            self.f.close()
+            self.index.close()
+            self.f = None
+
+
+class ErrorsFileReader(object):
+    """Reads the invalid rows page by page by their offsets, without loading
+    the whole errors file."""
+
+    def __init__(self, project):
+        self.path = project.errors_file
+        self.index_path = getIndexPath(self.path)
+        self.delimiter = str(project.delimiter)
+
+        if not os.path.exists(self.index_path):
+            convertOldErrorsFile(project)
+
+        # A file without rows has no header either
+        rows = self.readRows(0, 1)
+        self.headers = rows[0] if rows else []
+        self.column_count = self.getColumnCount()
+
+    def __len__(self):
+        # The first row is the header
+        return max(0, getIndexCount(os.path.getsize(self.index_path)) - 1)
+
+    def getColumnCount(self):
+        # The widest row, the invalid rows may have more cells than the header
+        with open(self.index_path, 'rb') as index:
+            return readIndexHeader(index)
+
+    def getRows(self, first, count):
+        return self.readRows(first + 1, count)
+
+    def readRows(self, first, count):
+        with open(self.index_path, 'rb') as index:
+            index.seek(INDEX_HEADER_SIZE + first * INDEX_ENTRY_SIZE)
+            offsets = unpackOffsets(index.read((count + 1) * INDEX_ENTRY_SIZE))
+
+        if not offsets:
+            return []
 
-    name = '{:%y%m%d_%H%M%S_%f}.json.zip'.format(datetime.datetime.now())
-    path = os.path.join(project.chunks_folder, name)
+        with open(self.path, 'rb') as f:
+            f.seek(offsets[0])
 
-    valid_rows = list(convertedRows(project, converters, rows))
+            if len(offsets) > count:
+                data = f.read(offsets[-1] - offsets[0])
+            else:
+                data = f.read()
+
+        reader = csv.reader(StringIO(data), delimiter=self.delimiter)
+        return list(reader)[:count]
+
+
+def convertOldErrorsFile(project):
+    # Files written before the index existed have no header, no quoting and no
+    # reasons, they are rewritten once in the recent format
+    errors = ErrorsFile(project)
+    old_path = errors.path + '.old'
+    os.rename(errors.path, old_path)
+
+    with open(old_path, 'rb') as f:
+        for line in f:
+            row = line.rstrip('\r\n').split(project.delimiter)
+            errors.addRows([['', ''] + row])
+
+    errors.close()
+    os.remove(old_path)
+
+
+def encodeCells(row):
+    # The csv module writes only byte strings, the posted JSON has unicode
+    return [v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+
+
+def getIndexPath(path):
+    return path + '.idx'
+
+
+def truncateErrorsFile(project):
+    # Removes the invalid rows written after the last committed chunk, they
+    # are found again when the rows after the checkpoint are processed
+    if project.checkpoint_errors_size is None:
+        return
+
+    if project.errors_file and not project.checkpoint_errors_size:
+        # Nothing was committed, not even the header
+        removeFile(project.errors_file)
+        removeFile(getIndexPath(project.errors_file))
+
+        project.errors_file = None
+        project.save()
+
+    elif project.errors_file and os.path.exists(project.errors_file):
+        truncateFile(project.errors_file, project.checkpoint_errors_size)
+
+        index_path = getIndexPath(project.errors_file)
+        if os.path.exists(index_path):
+            truncateFile(index_path, INDEX_HEADER_SIZE + project.checkpoint_errors_count * INDEX_ENTRY_SIZE)
 
-    json_str = json.dumps(valid_rows)
-    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
-        z.writestr('chunk.csv', json_str)
 
-    records_valid = len(valid_rows)
-    records_invalid = len(rows) - len(valid_rows)
-    models.addChunk(project, path, json_path, records_valid, records_invalid)
+def truncateFile(path, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size or 0)
 
-    models.updateRecordsCount(project)
 
+def readIndexHeader(index):
+    index.seek(0)
+    data = index.read(INDEX_HEADER_SIZE)
+
+    if len(data) < INDEX_HEADER_SIZE:
+        return 0
+
+    return struct.unpack(INDEX_HEADER, data)[0]
+
+
+def getIndexCount(index_size):
+    return max(0, index_size - INDEX_HEADER_SIZE) // INDEX_ENTRY_SIZE
+
+
+def packOffsets(offsets):
+    return struct.pack('<{}Q'.format(len(offsets)), *offsets)
+
+
+def unpackOffsets(data):
+    return struct.unpack('<{}Q'.format(len(data) // INDEX_ENTRY_SIZE), data)
+
+
+def processRows(project, errors, rows, getCheckpoint, freeDiskSpace):
+    # The checkpoint is taken when a chunk is read, and saved with the chunk.
+    # Over the disk budget, the steps of freeDiskSpace are run until the
+    # uploads free enough space.
+    writer = models.ChunkWriter(project)
+    pending = collections.deque()
+
+    for chunk in splitToChunks(rows):
+        # The rows found invalid while reading belong to this chunk
+        read_errors = errors.takeRows()
+
+        if isOverDiskBudget():
+            # The waiting chunks are committed first, so they can be uploaded
+            while pending:
+                for _ in finishOldestChunk(writer, errors, pending):
+                    yield
+
+            writer.flush()
+
+            for _ in freeDiskSpace():
+                yield
+
+        checkpoint = getCheckpoint()
+        pending.append((processChunk(project, chunk), checkpoint, read_errors))
+
+        while len(pending) > getMaxPendingChunks():
+            for _ in finishOldestChunk(writer, errors, pending):
+                yield
+
+    read_errors = errors.takeRows()
+
+    while pending:
+        for _ in finishOldestChunk(writer, errors, pending):
+            yield
+
+    if read_errors:
+        # The rows found invalid after the last chunk
+        errors.addRows(read_errors)
+        errors.flush()
+
+        checkpoint = getCheckpoint()
+        checkpoint.update(errors.getCheckpoint())
+        writer.addInvalidRecords(len(read_errors), checkpoint)
+
+    writer.flush()
+
+
+def splitToChunks(rows):
+    # The boundaries depend only on the input, so a chunk gets the same rows
+    # when the input is processed again
+    chunk = []
+    size = 0
 
-def convertedRows(project, converters, rows):
     for row in rows:
-        try:
-            yield [func(value) for func, value in zip(converters, row)]
-        except:
-            saveToErrorsFile(project, row)
+        chunk.append(row)
+        size += getRowSize(row)
 
+        if len(chunk) == config.ROWS_PER_CHUNK or size >= config.BYTES_PER_CHUNK:
+            yield chunk
+            chunk = []
+            size = 0
 
-def saveToErrorsFile(project, row):
-    folder = os.path.join(config.DB_FOLDER, str(project.id))
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+    if chunk:
+        yield chunk
 
-    project.errors_file = os.path.join(folder, 'validating_errors.csv')
-    project.save()
 
-    with open(project.errors_file, 'a') as f:
-        line = project.delimiter.join(row)
-        f.write(line + '\n')
+def getRowSize(row):
+    # The length of the cells plus the delimiters
+    try:
+        return sum(map(len, row)) + len(row)
+    except TypeError:
+        # Typed JSON values, a number is counted as 8 bytes
+        return sum(len(v) if isinstance(v, basestring) else 8 for v in row) + len(row)
 
 
-def getConverters(project):
-    d = {
-        'number': convertNumber,
-        'text': convertText,
-        'datetimestamp': convertStamp
-        }
+def processChunk(project, rows):
+    path = getChunkPath(project)
+    args = (project.validation, rows, path)
 
-    return [d[v] for v in project.validation.split(',')]
+    pool = getValidationPool()
+    if pool:
+        return pool.apply_async(chunks.convertChunk, args, callback=wakeUp)
+    else:
+        return DoneResult(chunks.convertChunk(*args))
+
+
+def getChunkPath(project):
+    now = datetime.datetime.now()
+    name = '{:%y%m%d_%H%M%S_%f}_{}'.format(now, next(chunk_numbers))
+    return os.path.join(project.chunks_folder, name)
 
 
-def convertNumber(value):
-    return float(value)
+def finishOldestChunk(writer, errors, pending):
+    async_result, checkpoint, read_errors = pending[0]
+
+    for _ in waitFor(async_result):
+        yield
 
+    pending.popleft()
+    path, codec_name, records_valid, invalid_rows = async_result.get()
+    addDiskUsage(path)
 
-def convertStamp(value):
-    return datetime.datetime.strptime(value, '%Y-%m-%d').isoformat()
+    errors.addRows(read_errors)
+    errors.addRows(invalid_rows)
+    errors.flush()
 
+    checkpoint.update(errors.getCheckpoint())
 
-def convertText(value):
-    return value
+    records_invalid = len(read_errors) + len(invalid_rows)
+    writer.addChunk(path, codec_name, records_valid, records_invalid, checkpoint)
+
+    yield
 
 
 # -----------------------------------------------------------------------------
@@ -259,14 +736,15 @@ def convertText(value):
 
 class UploadProcess(Process):
 
-    def __init__(self, project, post):
-        self.post = post
+    def __init__(self, project, handleResult):
+        self.handleResult = handleResult
+        self.window = UploadWindow()
 
         super(UploadProcess, self).__init__(project)
 
     def runProcess(self):
         self.project.status = "Uploading..."
-        self.project.save()
+        models.updateUploadedCount(self.project)
 
         for _ in uploadChunks(self, self.project):
             yield
@@ -278,32 +756,112 @@ class UploadProcess(Process):
 
 
 def uploadChunks(process, project):
-    for chunk in models.getChunksToUpload(project):
-        uploadChunk(process, chunk)
-        project.records_uploaded = models.getUploadedCount(project)
-        project.save()
-        yield
+    pending = collections.deque()
 
+    for chunk in models.iterChunksToUpload(project):
+        if not project.in_progress:
+            return
 
-def uploadChunk(process, chunk):
-    with zipfile.ZipFile(chunk.path, 'r') as z:
-        data = z.read('chunk.csv')
-        rows = json.loads(data)
+        while len(pending) >= process.window.size or isUploadLimitReached():
+            if pending:
+                for _ in finishOldestUpload(process, pending):
+                    yield
+            else:
+                for _ in waitUntil(lambda: not isUploadLimitReached()):
+                    yield
+
+        pending.append((chunk, uploadChunk(project, chunk)))
 
-    result, error = process.post('upload_rows', {
+    while pending and project.in_progress:
+        for _ in finishOldestUpload(process, pending):
+            yield
+
+
+def uploadChunk(project, chunk):
+    data = {
         'login_token': models.getLoginToken(),
-        'project_token': chunk.project.project_token,
-        'chunk_id': chunk.id,
-        'rows': rows
-        })
+        'project_token': project.project_token,
+        'chunk_id': chunk.id
+        }
+
+    args = (chunk.path, chunk.codec, project.validation, data)
+    async_result = getUploadPool().apply_async(uploadChunkCore, args, callback=wakeUp)
+
+    uploads.append(async_result)
+    return async_result
+
+
+def isUploadLimitReached():
+    # The uploads of all the processes together, finished or dropped ones are
+    # removed here
+    uploads[:] = [r for r in uploads if not r.ready()]
+    return len(uploads) >= config.UPLOAD_LIMIT
+
+
+def uploadChunkCore(path, codec_name, validation, data):
+    # Runs in an upload worker thread, so it must not touch the database
+    openBody = functools.partial(openChunkBody, path, codec_name, validation, data)
+
+    started = time.time()
+    result, error = api.postBody('upload_rows', openBody)
+
+    return result, error, time.time() - started
+
+
+def openChunkBody(path, codec_name, validation, data):
+    """Splices the already serialized rows of the chunk file into the JSON
+    envelope, the rows are streamed from the disk without decoding them when
+    the codec allows it."""
+    envelope = json.dumps(data)
+    prefix = envelope[:-1] + ', "rows": '
+    suffix = '}'
+
+    body = api.StreamBody()
+    chunks.getCodec(codec_name, validation).fillBody(body, path, prefix, suffix)
+    return body
+
+
+def finishOldestUpload(process, pending):
+    chunk, async_result = pending[0]
+
+    for _ in waitFor(async_result):
+        yield
+
+    pending.popleft()
+    result, error, seconds = async_result.get()
 
     if not error or error == "Already uploaded":
-        chunk.uploaded = True
-        chunk.save()
+        models.setChunkUploaded(process.project, chunk)
+        process.window.onUploaded(seconds)
+
+        if config.DELETE_UPLOADED_CHUNKS:
+            removeFile(chunk.path)
 
     else:
+        process.window.onFailed()
+        process.handleResult(result, error)
         process.stopProcess(error)
 
+    yield
+
+
+class UploadWindow(object):
+    """Number of chunks uploaded at the same time by a process, adapted to the
+    server: increased by one after a fast upload, halved after a slow or
+    failed one (AIMD). Slow includes the time spent on retries."""
+
+    def __init__(self):
+        self.size = config.UPLOAD_WINDOW_MIN
+
+    def onUploaded(self, seconds):
+        if seconds > config.UPLOAD_LATENCY_TARGET:
+            self.onFailed()
+        else:
+            self.size = min(self.size + 1, config.UPLOAD_WORKERS)
+
+    def onFailed(self):
+        self.size = max(self.size // 2, config.UPLOAD_WINDOW_MIN)
+
 
 # -----------------------------------------------------------------------------
 # SERVER PROCESS
@@ -311,28 +869,39 @@ def uploadChunk(process, chunk):
 
 class ServerProcess(Process):
 
-    def __init__(self, project, post):
+    def __init__(self, project, handleResult):
         self.project = project
-        self.post = post
-        self.converters = getConverters(project)
+        self.handleResult = handleResult
+        self.window = UploadWindow()
 
         super(ServerProcess, self).__init__(project)
 
+    def startProcess(self):
+        # The idle processes get no steps, so the generator can not clear it
+        self.project.idle = False
+        super(ServerProcess, self).startProcess()
+
     def processJsons(self):
         if self.project.idle:
             self.startProcess()
 
     def runProcess(self):
         self.project.status = "Running..."
-        self.project.idle = False
-        self.project.save()
+        models.updateUploadedCount(self.project)
 
-        while True:
-            for _ in self.runProcessCore():
-                yield
+        truncateErrorsFile(self.project)
+        self.queueOldPosts()
+        self.errors = ErrorsFile(self.project)
 
-            if not self.getPaths() and not models.getChunksToUpload(self.project):
-                break
+        try:
+            while True:
+                for _ in self.runProcessCore():
+                    yield
+
+                if not models.getNextSegment(self.project) and not models.hasChunksToUpload(self.project):
+                    break
+        finally:
+            self.errors.close()
 
         self.project.status = "Running... (idle)"
         self.project.idle = True
@@ -340,9 +909,9 @@ class ServerProcess(Process):
 
     def runProcessCore(self):
         while True:
-            paths = self.getPaths()
-            if paths:
-                for _ in self.processPaths(paths):
+            segment = models.getNextSegment(self.project)
+            if segment:
+                for _ in self.processSegment(segment):
                     yield
             else:
                 break
@@ -350,27 +919,256 @@ class ServerProcess(Process):
         for _ in uploadChunks(self, self.project):
             yield
 
-    def getPaths(self):
+    def freeDiskSpace(self):
+        # The chunks of the segments processed so far are uploaded, waiting
+        # any longer would only keep the segments on the disk
+        return uploadChunks(self, self.project)
+
+    def queueOldPosts(self):
+        # The post files of the older versions, and a segment closed by a
+        # crash before it was queued
         folder = self.project.posts_folder
-        if folder:
-            names = sorted(os.listdir(folder))
-            paths = [os.path.join(folder, name) for name in names]
-            return paths
+        if folder and os.path.exists(folder):
+            queued = models.getSegmentPaths(self.project)
+            paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+            paths = [path for path in paths if segments.isPostPath(path) and path not in queued]
 
-    def processPaths(self, paths):
-        for path in paths:
-            with open(path) as f:
-                rows = json.load(f)
+            # The older versions linked the chunks to the post file, and
+            # removed the file only when all of its chunks were written
+            for path in paths:
+                models.removeBrokenChunks(self.project, path)
 
-            models.removeBrokenChunks(self.project, path)
+            if paths:
+                models.addSegments(self.project.id, paths)
 
-            str_rows = [[str(v) for v in row] for row in rows]
-            for _ in processRows(self.project, self.converters, str_rows, path):
+    def processSegment(self, segment):
+        self.segment_id = segment.id
+
+        # The rows are read while they are processed, so only a few chunks
+        # are in the memory, whatever the size of the POST body
+        if os.path.exists(segment.path):
+            rows = self.iterRows(segment)
+            for _ in processRows(self.project, self.errors, rows, self.getCheckpoint, self.freeDiskSpace):
                 yield
 
-            os.remove(path)
+            self.errors.flush()
+
+        # The file is removed first, so a processed segment is never queued
+        # again by queueOldPosts
+        removeFile(segment.path)
+        models.removeSegment(self.project, segment, self.errors.getCheckpoint())
+
+    def iterRows(self, segment):
+        if self.project.ingest_segment_id == segment.id:
+            offset, skip = self.project.ingest_offset or 0, self.project.ingest_row or 0
+        else:
+            offset, skip = 0, 0
+
+        self.cursor = (offset, skip)
+
+        # The invalid JSON values are counted as rows too, so they are not
+        # reported again when the processing continues inside the record
+        for offset, format, record in segments.readRecords(segment.path, offset):
+            for number, (row, error) in enumerate(self.decodeRecord(format, record)):
+                if number >= skip:
+                    self.cursor = (offset, number + 1)
+                    if error:
+                        self.errors.addRows([error])
+                    else:
+                        yield row
+
+            skip = 0
+            self.cursor = (record.end, 0)
+
+    def decodeRecord(self, format, record):
+        """Yields (row, None) for the rows of the record, and (None, error)
+        for the values which can not be decoded."""
+        if format == segments.CSV:
+            for row in csv.reader(record, delimiter=str(self.project.delimiter)):
+                if row:
+                    yield row, None
+
+        elif format == segments.NDJSON:
+            for line in record:
+                if line.strip():
+                    for item in self.decodeRows(line, False):
+                        yield item
+
+        else:
+            for item in self.decodeRows(record.read(), True):
+                yield item
+
+    def decodeRows(self, text, is_list):
+        try:
+            value = json.loads(text)
+        except ValueError, e:
+            return [(None, [0, "Invalid JSON: {}".format(e)])]
 
+        # The values are validated as they are, see chunks.convertNumber
+        rows = value if is_list else [value]
+
+        if not isinstance(rows, list) or not all(type(row) is list for row in rows):
+            return [(None, [0, "Rows should be JSON lists"])]
+
+        return ((row, None) for row in rows)
+
+    def getCheckpoint(self):
+        offset, row = self.cursor
+        return {'ingest_segment_id': self.segment_id, 'ingest_offset': offset, 'ingest_row': row}
+
+
+# -----------------------------------------------------------------------------
+# DISK SPACE
+
+# The usage of the DB folder is measured again every DISK_USAGE_SECONDS, in
+# between only the written chunk files and the removed files are counted, to
+# keep it cheap.
+
+
+class DiskBudgetError(Exception):
+
+    def __init__(self):
+        message = "The DB folder is over the disk budget of {} bytes".format(config.DISK_BUDGET)
+        super(DiskBudgetError, self).__init__(message)
+
+
+def waitForDiskSpace(project):
+    # Only the removal of the uploaded chunks frees space, so the waiting
+    # ends when there is nothing left to upload
+    def isDone():
+        backlog = (project.records_valid or 0) - (project.records_uploaded or 0)
+        return not isOverDiskBudget() or not backlog or not project.in_progress
+
+    status = project.status
+    project.status = "Waiting for disk space..."
+    project.save()
+
+    if config.DELETE_UPLOADED_CHUNKS:
+        for _ in waitUntil(isDone):
+            yield
+
+    project.status = status
+    project.save()
+
+    if project.in_progress and isOverDiskBudget():
+        raise DiskBudgetError()
+
+
+def isOverDiskBudget():
+    return config.DISK_BUDGET and getDiskUsage() >= config.DISK_BUDGET
+
+
+def getDiskUsage():
+    global disk_usage, disk_measured_at
+
+    now = time.time()
+    if disk_usage is None or now - disk_measured_at >= config.DISK_USAGE_SECONDS:
+        disk_measured_at = now
+        disk_usage = 0
+        for folder, _, names in os.walk(config.DB_FOLDER):
+            for name in names:
+                disk_usage += os.path.getsize(os.path.join(folder, name))
+
+    return disk_usage
+
+
+def addDiskUsage(path):
+    global disk_usage
+
+    if disk_usage is not None:
+        disk_usage += os.path.getsize(path)
+
+
+def removeFile(path):
+    global disk_usage
+
+    if os.path.exists(path):
+        size = os.path.getsize(path)
+        os.remove(path)
+
+        if disk_usage is not None:
+            disk_usage -= size
+
+
+# -----------------------------------------------------------------------------
+# WORKER POOLS
+
+
+class DoneResult(object):
+    """Result of a job run in place, with the interface of AsyncResult."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+def waitFor(async_result):
+    return waitUntil(async_result.ready)
+
+
+def waitUntil(isReady):
+    # Steps only waiting are marked, so the manager can poll slower
+    global waiting
+
+    while not isReady():
+        waiting = True
+        yield
+
+
+def wakeUp(result):
+    # Runs in a thread of the pool, the manager runs in the main thread
+    if wake_up:
+        wake_up()
+
+
+def getValidationPool():
+    global validation_pool
+
+    if validation_pool is None and config.VALIDATION_WORKERS != 0:
+        validation_pool = multiprocessing.Pool(getValidationWorkers())
+
+    return validation_pool
+
+
+def getValidationWorkers():
+    return config.VALIDATION_WORKERS or multiprocessing.cpu_count()
+
+
+def getMaxPendingChunks():
+    if getValidationPool():
+        return 2 * getValidationWorkers()
+    else:
+        return 0
+
+
+def getUploadPool():
+    global upload_pool
+
+    if not upload_pool:
+        upload_pool = ThreadPool(config.UPLOAD_LIMIT)
+
+    return upload_pool
 
 
 # -----------------------------------------------------------------------------
 # MAIN
+
+# The index of the errors file: the width of the widest row, then the offset
+# of every row
+INDEX_HEADER = '<Q'
+INDEX_HEADER_SIZE = struct.calcsize(INDEX_HEADER)
+INDEX_ENTRY_SIZE = struct.calcsize('<Q')
+
+chunk_numbers = itertools.count()
+disk_usage = None
+disk_measured_at = 0
+uploads = []
+waiting = False
+wake_up = None
+upload_pool = None
+validation_pool = None
@@ -2,8 +2,6 @@
 # IMPORTS
 
 # Standard library imports
-import datetime
-import json
 import os
 import re
 import sys
@@ -21,6 +19,7 @@ from twisted.web.server import Site
 from utils import config
 from utils import excepthook
 import models
+import segments
 
 # -----------------------------------------------------------------------------
 # CLASSES
@@ -32,16 +31,17 @@ class Server(Resource):
 
     def __init__(self, processJsons):
         self.processJsons = processJsons
+        self.spoolers = {}
 
     def render_GET(self, request):
         try:
-            project, error = getRunningProject('test', request.uri)
+            id, project, error = getRunningProject('test', request.uri)
 
             if error:
                 request.setResponseCode(403)
                 return error
             else:
-                return "Real time server #{} is accepting requests".format(project.id)
+                return "Real time server #{} is accepting requests".format(id)
 
         except:
             request.setResponseCode(500)
@@ -49,21 +49,79 @@ class Server(Resource):
 
     def render_POST(self, request):
         try:
-            project, error = getRunningProject('post', request.uri)
+            id, project, error = getRunningProject('post', request.uri)
 
             if error:
                 request.setResponseCode(403)
                 return error
             else:
-                rows = json.loads(request.content.read())
-                message = processPost(project, rows)
-                self.processJsons(project)
-                return message
+                # Twisted keeps a big or chunked body in a temporary file
+                body = request.content
+                body.seek(0, os.SEEK_END)
+                length = body.tell()
+                body.seek(0)
+
+                format = segments.getFormat(request.getHeader('content-type'))
+                if format == segments.JSON and not looksLikeJsonList(body.read(1024)):
+                    request.setResponseCode(400)
+                    return "The body should be a JSON list of rows"
+
+                body.seek(0)
+                self.getSpooler(id, project).addBody(format, body, length)
+                return "{} byte(s) accepted".format(length)
 
         except:
             request.setResponseCode(500)
             return handleException()
 
+    def getSpooler(self, id, project):
+        # The ID comes from the URL, reading project.id after a commit would
+        # reload the project
+        if id not in self.spoolers:
+            self.spoolers[id] = Spooler(project, self.processJsons)
+
+        return self.spoolers[id]
+
+
+class Spooler(object):
+    """Appends the POST bodies of a project to a segment file, without decoding
+    them. The segment is closed after SEGMENT_SECONDS or SEGMENT_BYTES, and
+    only then is the project process notified, so the database work is done
+    once per segment, not per request."""
+
+    def __init__(self, project, processJsons):
+        self.project = project
+        self.processJsons = processJsons
+        self.delayed_call = None
+
+        folder = os.path.join(config.DB_FOLDER, str(project.id), 'posts')
+        self.writer = segments.SegmentWriter(folder)
+
+        if project.posts_folder != folder:
+            project.posts_folder = folder
+            project.save()
+
+    def addBody(self, format, f, length):
+        self.writer.append(format, f, length)
+
+        if self.writer.size >= config.SEGMENT_BYTES:
+            self.closeSegment()
+        elif not self.delayed_call:
+            self.delayed_call = reactor.callLater(config.SEGMENT_SECONDS, self.closeSegment)
+
+    def closeSegment(self):
+        if self.delayed_call and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+        path = self.writer.close()
+        if path:
+            models.addSegments(self.project.id, [path])
+
+            # A stopped project is not started again by its last segment
+            if isRunning(self.project):
+                self.processJsons(self.project)
+
 
 # -----------------------------------------------------------------------------
 # FUNCTIONS
@@ -74,22 +132,39 @@ def getRunningProject(name, uri):
     if id is None:
         project = None
         error = "Invalid URL"
-    else:
 
+    elif id in running_projects:
+        project = running_projects[id]
+        error = None
+
+    else:
+        # Only the unknown and the stopped projects are read from the database
         project = models.getProjectById(id)
         if not project or project.type_name != 'Server':
             error = "There is no real time server with ID #{}".format(id)
-        elif project.in_progress or project.idle:
+        elif isRunning(project):
+            running_projects[id] = project
             error = None
         else:
             error = "Real time server #{} is stopped".format(id)
 
-    return project, error
+    return id, project, error
+
+
+def updateRunningProjects(project):
+    # Called at every save, so a stopped project is refused at once
+    if project.type_name == 'Server' and isRunning(project):
+        running_projects[project.id] = project
+    else:
+        running_projects.pop(project.id, None)
+
+
+def isRunning(project):
+    return project.in_progress or project.idle
 
 
 def getProjectId(name, uri):
-    pattern = re.compile('/(\d+)/' + name + '/?$', re.IGNORECASE)
-    match = re.search(pattern, uri)
+    match = routes[name].search(uri)
 
     if match:
         return int(match.group(1))
@@ -100,27 +175,39 @@ def handleException():
     return "Server error: {}".format(sys.exc_value)
 
 
-def processPost(project, rows):
-    folder = os.path.join(config.DB_FOLDER, str(project.id), 'posts')
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-    project.posts_folder = folder
-    project.save()
+def looksLikeJsonList(start):
+    # A cheap check of the start only, the body is decoded when its segment
+    # is processed
+    return json_list_pattern.match(start) is not None
 
-    now = '{:%y%m%d_%H%M%S_%f}'.format(datetime.datetime.now())
-    path = os.path.join(folder, now + '.json')
 
-    with open(path, 'w') as f:
-        json.dump(rows, f)
-
-    return "{} row(s) processed".format(len(rows))
+def queueOpenSegments():
+    # The segments left open by a crash are closed and queued at the start,
+    # not only when the next POST request of the project arrives
+    for project in models.getServerProjects():
+        if project.posts_folder and os.path.exists(project.posts_folder):
+            path = segments.SegmentWriter(project.posts_folder).close()
+            if path:
+                models.addSegments(project.id, [path])
 
 
 def startServer(processJsons):
+    models.save_listeners.append(updateRunningProjects)
+    queueOpenSegments()
+
     server = Server(processJsons)
     reactor.listenTCP(config.PORT, Site(server))
 
 
 # -----------------------------------------------------------------------------
 # MAIN
+
+json_list_pattern = re.compile(r'\s*\[')
+
+routes = {
+    'test': re.compile(r'/(\d+)/test/?$', re.IGNORECASE),
+    'post': re.compile(r'/(\d+)/post/?$', re.IGNORECASE),
+    }
+
+# The real time servers accepting requests, by project ID
+running_projects = {}
@@ -2,19 +2,20 @@
 # IMPORTS
 
 # Standard library imports
-import functools
-import json
+import collections
+import multiprocessing
 import os
-import time
 import sys
 
 # Related third party imports
 from PySide import QtCore, QtGui
-import requests
+from twisted.internet import threads
+from twisted.python import failure
 
 # Local application/library specific imports
 from utils import config
 from utils import excepthook
+import api
 import models
 import processes
 
@@ -352,15 +353,17 @@ class MainWindow(QtGui.QMainWindow):
 
         else:
             if project.type_name == 'Server':
-                process = processes.ServerProcess(project, post)
+                process = processes.ServerProcess(project, handleResult)
+            elif not project.validated and config.STREAMING_UPLOAD:
+                process = processes.StreamingProcess(project, handleResult)
             elif not project.validated:
                 process = processes.ValidationAndSplitProcess(project)
             else:
-                process = processes.UploadProcess(project, post)
+                process = processes.UploadProcess(project, handleResult)
 
             manager.addProcess(project, process)
 
-        QtCore.QTimer().singleShot(10, manager.runProcesses)
+        manager.runProcesses()
         self.enableDisableButtons()
 
     def onPauseClicked(self):
@@ -379,14 +382,13 @@ class MainWindow(QtGui.QMainWindow):
         count = self.getCountById(project.id)
 
         if count is not None:
-            row = self.model.loadRow(project)
-            self.model.rows[count] = row
+            self.model.rows[count] = self.model.loadRow(project)
 
-            for index, _ in enumerate(row):
-                self.model.dataChanged.emit(count, index)
+            first = self.model.createIndex(count, 0)
+            last = self.model.createIndex(count, len(self.model.header) - 1)
+            self.model.dataChanged.emit(first, last)
 
         self.enableDisableButtons()
-        self.setColumnWidths()
 
 
 class TableModel(QtCore.QAbstractTableModel):
@@ -540,6 +542,9 @@ class AddNewWindow(QtGui.QDialog):
         label_form = QtGui.QLabel(u"Form name:")
         label_form.setAlignment(int(QtCore.Qt.AlignVCenter | QtCore.Qt.AlignRight))
 
+        label_priority = QtGui.QLabel(u"Priority:")
+        label_priority.setAlignment(int(QtCore.Qt.AlignVCenter | QtCore.Qt.AlignRight))
+
         if not self.is_server:
             label_file = QtGui.QLabel(u"File:")
             label_file.setAlignment(int(QtCore.Qt.AlignVCenter | QtCore.Qt.AlignRight))
@@ -550,6 +555,9 @@ class AddNewWindow(QtGui.QDialog):
         for name in self.form_names:
             self.drop_form.addItem(name)
 
+        self.spin_priority = QtGui.QSpinBox()
+        self.spin_priority.setRange(1, 10)
+
         cancel_button = createButton("Cancel", 'gtk-cancel.png', self.close)
         self.create_button = createButton("&" + text, 'list-add.png', self.onCreate)
         self.create_button.setDefault(True)
@@ -562,12 +570,14 @@ class AddNewWindow(QtGui.QDialog):
         grid = QtGui.QGridLayout()
         grid.addWidget(label_name, 0, 0)
         grid.addWidget(label_form, 1, 0)
+        grid.addWidget(label_priority, 2, 0)
         if not self.is_server:
-            grid.addWidget(label_file, 2, 0)
+            grid.addWidget(label_file, 3, 0)
         grid.addWidget(self.edit_name, 0, 1)
         grid.addWidget(self.drop_form, 1, 1)
+        grid.addWidget(self.spin_priority, 2, 1)
         if not self.is_server:
-            grid.addWidget(self.button_file, 2, 1)
+            grid.addWidget(self.button_file, 3, 1)
 
         hbox = QtGui.QHBoxLayout()
         hbox.addWidget(cancel_button)
@@ -627,7 +637,7 @@ class AddNewWindow(QtGui.QDialog):
 
                 project_id = models.addProject(
                     name, form_name, type_name, self.path, project_token,
-                    self.delimiter, validation
+                    self.delimiter, validation, self.spin_priority.value()
                     )
                 main_window.reloadTable(project_id)
                 self.close()
@@ -762,41 +772,50 @@ class InvalidRowsWindow(QtGui.QDialog):
 
 class InvalidRowsModel(QtCore.QAbstractTableModel):
 
-    def __init__(self, project):
-        self.project = project
+    page_size = 500
+    max_pages = 20
 
-        self.headers = project.validation.split(',')
-        self.loadRows()
-        self.calcColumnCount()
+    def __init__(self, project):
+        self.reader = processes.ErrorsFileReader(project)
+        self.headers = self.reader.headers
+        self.column_count = max(len(self.headers), self.reader.column_count)
+        self.row_count = len(self.reader)
+        self.pages = collections.OrderedDict()
 
         super(InvalidRowsModel, self).__init__()
 
-    def loadRows(self):
-        with open(self.project.errors_file) as f:
-            self.rows = [
-                line.replace('\n', '').split(self.project.delimiter)
-                for line in f
-                ]
+    def getRow(self, num):
+        page_num = num // self.page_size
 
-    def rowCount(self, parent):
-        return len(self.rows)
+        if page_num in self.pages:
+            page = self.pages.pop(page_num)
+        else:
+            page = self.reader.getRows(page_num * self.page_size, self.page_size)
+
+        # The most recently used pages are kept at the end
+        self.pages[page_num] = page
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
 
-    def calcColumnCount(self):
-        self.column_count = len(self.headers)
-        for row in self.rows:
-            self.column_count = max(self.column_count, len(row))
+        return page[num % self.page_size]
+
+    def rowCount(self, parent):
+        return self.row_count
 
     def columnCount(self, parent):
         return self.column_count
 
     def data(self, index, role):
         if role == QtCore.Qt.DisplayRole:
-            return self.rows[index.row()][index.column()]
+            row = self.getRow(index.row())
+            if index.column() < len(row):
+                return row[index.column()]
 
     def headerData(self, num, orientation, role):
         if role == QtCore.Qt.DisplayRole:
             if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
-                return self.headers[num]
+                if num < len(self.headers):
+                    return self.headers[num]
             elif orientation == QtCore.Qt.Vertical and role == QtCore.Qt.DisplayRole:
                 return "{}.".format(num + 1)
 
@@ -843,51 +862,58 @@ def setTitleAndIcon(window, title, icon_name):
 # FUNCTIONS - API
 
 
-def post(route, data, count=0):
+def post(route, data):
     data['login_token'] = models.getLoginToken()
 
     try:
-        result = post_core(route, data)
-        error = result.get('error')
-
-        if error == "Invalid login token":
-            login_window = LoginWindow()
-            login_window.exec_()
-        elif error:
-            QtGui.QMessageBox.critical(None, "Error happened", error)
-
-        return result, error
-
-    except requests.ConnectionError:
-        if count < 2:
-            time.sleep(0.1)
-            return post(route, data, count+1)
-        else:
-            error = "The server is unreachable"
-            QtGui.QMessageBox.critical(None, "Error happened", error)
-            return None, error
+        result, error = callInThread(api.post, route, data)
 
     except Exception, e:
         QtGui.QMessageBox.critical(None, "Error happened", str(e))
         raise
 
+    return handleResult(result, error)
 
-def post_core(route, data):
-    url = "{}/{}".format(config.API_URL, route)
-    json_data = json.dumps(data)
-    headers = {'content-type': 'application/json'}
 
-    r = requests.post(url, data=json_data, headers=headers)
+def handleResult(result, error):
+    if error == "Invalid login token":
+        login_window = LoginWindow()
+        login_window.exec_()
+    elif error:
+        QtGui.QMessageBox.critical(None, "Error happened", error)
 
-    if r.status_code == 200:
-        return r.json()
-    else:
-        raise Exception(r.content)
+    return result, error
 
 
-def processJsons(project):
-    func = functools.partial(manager.processJsons, project)
-    QtCore.QTimer().singleShot(10, func)
+def callInThread(func, *args):
+    """Runs func in a thread of the reactor while the GUI keeps handling the
+    events, then returns its result or raises its exception. The API calls
+    with their retries run this way, never on the GUI thread. The active
+    window is disabled meanwhile, so the same call can't be started twice."""
+    loop = QtCore.QEventLoop()
+    results = []
+
+    def onDone(result):
+        results.append(result)
+        loop.quit()
+
+    window = QtGui.QApplication.activeWindow()
+    if window:
+        window.setEnabled(False)
+
+    try:
+        threads.deferToThread(func, *args).addBoth(onDone)
+        if not results:
+            loop.exec_()
+    finally:
+        if window:
+            window.setEnabled(True)
+
+    result = results[0]
+    if isinstance(result, failure.Failure):
+        result.raiseException()
+
+    return result
 
 
 # -----------------------------------------------------------------------------
@@ -905,27 +931,45 @@ def handleRunningProjects():
             project.save()
 
         else:
-            process = processes.ServerProcess(project, post)
+            process = processes.ServerProcess(project, handleResult)
             manager.addProcess(project, process)
-            QtCore.QTimer().singleShot(10, manager.runProcesses)
+            manager.runProcesses()
 
 
 # -----------------------------------------------------------------------------
 # MAIN
 
-sys.excepthook = excepthook.excepthook
+# The validation worker processes import this module on Windows, they must not
+# open the database or start the application
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    sys.excepthook = excepthook.excepthook
+    models.openDatabase()
+
+    app = QtGui.QApplication(sys.argv)
+
+    # Should import after QApplication is created
+    from real_time_server import real_time_server
+    from twisted.internet import reactor
+
+    manager = processes.ProcessManager(handleResult, reactor.callLater, reactor.callFromThread)
+
+    real_time_url = real_time_server.startServer(manager.processJsons)
+    reactor.runReturn()
 
-app = QtGui.QApplication(sys.argv)
-manager = processes.ProcessManager(post, app.processEvents)
+    handleRunningProjects()
 
-# Should import after QApplication is created
-from real_time_server import real_time_server
-real_time_url = real_time_server.startServer(processJsons)
+    main_window = MainWindow()
+    connecting_window = ConnectingWindow()
 
-handleRunningProjects()
+    notification_timer = QtCore.QTimer()
+    notification_timer.timeout.connect(models.deliverNotifications)
+    notification_timer.start(1000 / config.NOTIFICATIONS_PER_SECOND)
+    connecting_window.show()
 
-main_window = MainWindow()
-connecting_window = ConnectingWindow()
-connecting_window.show()
+    status = app.exec_()
 
-sys.exit(app.exec_())
+    # Stops the thread pool of the reactor
+    reactor.fireSystemEvent('shutdown')
+    sys.exit(status)
@@ -0,0 +1,177 @@
+# -----------------------------------------------------------------------------
+# IMPORTS
+
+# Standard library imports
+import datetime
+import os
+import struct
+
+# Related third party imports
+
+# Local application/library specific imports
+
+# -----------------------------------------------------------------------------
+# CLASSES
+
+# A segment file holds the bodies of many POST requests as they arrived, each
+# one after its format and length. The open segment has a .part name, it is
+# renamed to a .seg file when closed, and only the closed segments are
+# processed.
+
+
+class SegmentWriter(object):
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.part_path = os.path.join(folder, 'segment.part')
+        self.f = None
+        self.size = 0
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def append(self, format, f, length):
+        """Copies length bytes of the file f block by block, so the body is
+        never held in the memory."""
+        if not self.f:
+            self.f = open(self.part_path, 'ab')
+            self.f.seek(0, os.SEEK_END)
+            self.size = self.f.tell()
+
+            if not self.size:
+                self.f.write(MAGIC)
+                self.size = len(MAGIC)
+
+        self.f.write(struct.pack(HEADER, format, length))
+
+        remaining = length
+        while remaining:
+            block = f.read(min(remaining, BLOCK_SIZE))
+            if not block:
+                raise IOError("Unexpected end of the request body")
+
+            self.f.write(block)
+            remaining -= len(block)
+
+        self.f.flush()
+        self.size += HEADER_SIZE + length
+
+    def close(self):
+        """Returns the path of the closed segment. A segment left open by a
+        crash is closed as it is, the reader skips its incomplete last record."""
+        if self.f:
+            self.f.close()
+            self.f = None
+
+        if os.path.exists(self.part_path):
+            now = datetime.datetime.now()
+            path = os.path.join(self.folder, '{:%y%m%d_%H%M%S_%f}.seg'.format(now))
+            os.rename(self.part_path, path)
+            return path
+
+
+class RecordReader(object):
+    """File-like view of one record of a segment, read by blocks or lines."""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+        self.end = f.tell() + length
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+
+            yield line
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self):
+        if not self.remaining:
+            return ''
+
+        line = self.f.readline(self.remaining)
+        self.remaining -= len(line)
+        return line
+
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS
+
+
+def readRecords(path, offset=0):
+    """Yields the offset, the format and a reader of the records from the
+    offset, the incomplete last record of a crashed segment is skipped. The
+    post files of the older versions are read as one JSON record."""
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        if not isSegmentPath(path):
+            if offset < size:
+                yield 0, JSON, RecordReader(f, size)
+            return
+
+        # A crash can leave a segment without even its magic
+        if f.read(len(MAGIC)) != MAGIC:
+            return
+
+        if offset > f.tell():
+            f.seek(offset)
+
+        while True:
+            offset = f.tell()
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                break
+
+            format, length = struct.unpack(HEADER, header)
+
+            if f.tell() + length > size:
+                break
+
+            record = RecordReader(f, length)
+            yield offset, format, record
+            f.seek(record.end)
+
+
+def isSegmentPath(path):
+    return path.endswith('.seg')
+
+
+def isPostPath(path):
+    # The closed segments, and the JSON files of the older versions
+    return path.endswith('.seg') or path.endswith('.json')
+
+
+def getFormat(content_type):
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    return FORMATS.get(media_type, JSON)
+
+
+# -----------------------------------------------------------------------------
+# MAIN
+
+# Formats of the records: a JSON list of rows, one JSON row per line, or CSV
+JSON = 'j'
+NDJSON = 'n'
+CSV = 'c'
+
+FORMATS = {
+    'application/x-ndjson': NDJSON,
+    'application/ndjson': NDJSON,
+    'application/jsonl': NDJSON,
+    'text/csv': CSV,
+    }
+
+MAGIC = 'SEG2'
+HEADER = '<cQ'
+HEADER_SIZE = struct.calcsize(HEADER)
+BLOCK_SIZE = 64 * 1024
@@ -5,6 +5,22 @@ VERSION = '2.3'
 # The URL of the API server, including the port
 API_URL = 'http://127.0.0.1:5000'
 
+# Connections kept alive to the API server, and the connect and read timeouts
+# of the API calls in seconds
+HTTP_POOL_SIZE = 8
+HTTP_TIMEOUT = (5, 60)
+
+# Failed API calls are retried with exponential backoff, waiting a random
+# time up to BASE * 2 ** retry seconds, but at most MAX seconds
+HTTP_RETRIES = 5
+HTTP_BACKOFF_BASE = 0.1
+HTTP_BACKOFF_MAX = 10
+
+# Sends gzip encoded requests, chunks are sent straight from the compressed
+# chunk files. The API server must accept gzip (multi-member) request bodies.
+HTTP_GZIP = False
+HTTP_GZIP_LEVEL = 6
+
 # The port and URL of the embedded real time server
 PORT = 8880
 URL = 'http://localhost:{}'.format(PORT)
@@ -15,8 +31,74 @@ LOGO_PATH = 'images/logo.png'
 # The folder of the database and temporary filess
 DB_FOLDER = 'db'
 
-# Number of rows in one chunk to be uploaded to the server in one POST call
+# The rows of the main window are updated at most this many times per second
+NOTIFICATIONS_PER_SECOND = 5
+
+# SQLite settings of the database: write-ahead logging lets the readers run
+# while committing, the cache size is in KiB when negative
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_CACHE_SIZE = -20000
+
+# Maximum number of rows and size of the input in one chunk, uploaded to the
+# server in one POST call. A chunk is closed at whichever limit comes first.
 ROWS_PER_CHUNK = 400
+BYTES_PER_CHUNK = 256 * 1024
+
+# New chunks are committed to the database in batches, after this many chunks
+# or this many seconds, whichever comes first
+CHUNKS_PER_COMMIT = 50
+SECONDS_PER_COMMIT = 1.0
+
+# File format of the new chunks: 'zip-json', 'json' (uncompressed), 'gzip-json'
+# or 'columnar' (typed binary columns, compressed with 'none', 'zlib', or 'lz4'
+# and 'zstd' when those packages are installed)
+CHUNK_CODEC = 'zip-json'
+CHUNK_COMPRESSOR = 'zlib'
+CHUNK_COMPRESSION_LEVEL = 6
+
+# Number of chunks read from the database at once when uploading
+CHUNKS_PER_PAGE = 200
+
+# Number of worker processes converting and compressing the chunks: None means
+# one per CPU core, 0 means converting in the GUI process
+VALIDATION_WORKERS = None
+
+# Number of chunks uploaded at the same time by the upload worker threads. A
+# process starts with UPLOAD_WINDOW_MIN parallel uploads, and adds one after
+# every upload faster than UPLOAD_LATENCY_TARGET seconds, up to UPLOAD_WORKERS.
+# Slow or failed uploads halve the number. All the projects together upload at
+# most UPLOAD_LIMIT chunks at the same time, this is the number of threads.
+UPLOAD_LIMIT = 8
+UPLOAD_WORKERS = 4
+UPLOAD_WINDOW_MIN = 1
+UPLOAD_LATENCY_TARGET = 2.0
+
+# The chunk files are removed after the upload when DELETE_UPLOADED_CHUNKS is
+# set. When the DB folder is bigger than DISK_BUDGET bytes, the processes
+# uploading while validating let the uploads free some space first. A File
+# project stops with an error when its uploads can not free enough, or when
+# it is validated before the upload. None means no limit. The folder is
+# measured again every DISK_USAGE_SECONDS.
+DELETE_UPLOADED_CHUNKS = True
+DISK_BUDGET = None
+DISK_USAGE_SECONDS = 1.0
+
+# The real-time server appends the POST bodies of a project to a segment file,
+# which is closed and processed after SEGMENT_SECONDS or SEGMENT_BYTES
+SEGMENT_SECONDS = 1.0
+SEGMENT_BYTES = 4 * 1024 * 1024
+
+# Seconds between two rounds of the process manager while every process is
+# waiting for the validation or the upload workers. The workers wake the
+# manager when a job is done, so this is only a fallback.
+POLL_SECONDS = 1.0
+
+# Streaming mode validates and uploads File projects in one pass. The reading
+# of the input waits while STREAMING_BACKLOG_ROWS validated rows are waiting
+# for upload.
+STREAMING_UPLOAD = False
+STREAMING_BACKLOG_ROWS = 20 * ROWS_PER_CHUNK
 
 # Debug mode prints exceptions
 DEBUG = True